@@ -1,56 +1,211 @@
-import os, json, re
+import os, io, sys, json, re, asyncio, argparse, hashlib, shutil, tempfile, functools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import accumulate, chain, repeat
 from pathlib import Path
 
-import requests
+import fastjsonschema
+import httpx
 import pydyf
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from lxml import html as lxhtml
+from pypdf import PdfReader, PdfWriter
 from weasyprint import HTML
+from weasyprint.text.fonts import FontConfiguration
+
+try:
+    import orjson
+except ImportError:  # stdlib json is a drop-in fallback
+    orjson = None
 
 PROVIDER = os.getenv("PROVIDER", "openai").lower()
 
 SUBJECTS_FILE = "subjects.txt"
 BOOK_HTML = "book.html"
 BOOK_PDF = "Destination C1 and C2 @destination_b1_b2_c1.pdf"
+DEBUG_HTML = os.getenv("DEBUG_HTML", "0") == "1"
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_ATTEMPTS = int(os.getenv("LLM_ATTEMPTS", "3"))  # per unit, for unparsable/invalid JSON
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count()
+
+# Batch mode needs an OpenAI-compatible /files + /batches API (GitHub Models has none).
+USE_BATCH = os.getenv("USE_BATCH", "0") == "1"
+BATCH_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+BATCH_POLL_SECONDS = int(os.getenv("BATCH_POLL_SECONDS", "30"))
+
+# Raw LLM responses keyed by prompt hash; CLEAR_CACHE=1 forces regeneration.
+CACHE_DIR = Path(".llm_cache")
+CLEAR_CACHE = os.getenv("CLEAR_CACHE", "0") == "1"
+
+# Parsed JSON per finished unit/review, so a crashed run resumes where it stopped.
+CHECKPOINT_DIR = Path("out")
+
+_TRAIL_COMMA_RE = re.compile(r",\s*([\]\}])")
+_FENCE_HEAD = re.compile(r"^```[a-zA-Z]*\n?")
+_FENCE_TAIL = re.compile(r"\n?```$")
+_PLACEHOLDER_RE = re.compile(r"\{\{(\w+)\}\}")
 
 # -------------------- LLM --------------------
 
-def call_github_models(prompt: str) -> str:
+def chat_payload(prompt: str) -> dict:
+    return {
+        "model": "gpt-4.1",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.2,
+        "response_format": {"type": "json_object"}
+    }
+
+
+def new_client() -> httpx.AsyncClient:
+    # One pooled HTTP/2 client per run; keep-alive covers every concurrent call
+    # so TLS handshakes happen once instead of per request.
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=180,
+        limits=httpx.Limits(
+            max_connections=LLM_CONCURRENCY,
+            max_keepalive_connections=LLM_CONCURRENCY,
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def github_headers() -> dict:
     key = os.getenv("GITHUB_TOKEN")
     if not key:
         raise SystemExit("Set GITHUB_TOKEN")
-
-    url = "https://models.inference.ai.azure.com/chat/completions"
-    headers = {
+    return {
         "Authorization": f"Bearer {key}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "model": "gpt-4.1",
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.2
-    }
-    r = requests.post(url, headers=headers, json=payload, timeout=180)
+
+
+# Rate limits and gateway errors are worth retrying; other 4xx are not.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUSES
+    return isinstance(exc, httpx.TransportError)  # includes timeouts
+
+
+@retry(
+    wait=wait_exponential_jitter(1, 30),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+async def call_github_models_async(client: httpx.AsyncClient, prompt: str) -> str:
+    url = "https://models.inference.ai.azure.com/chat/completions"
+    r = await client.post(url, headers=github_headers(), json=chat_payload(prompt))
     r.raise_for_status()
     return r.json()["choices"][0]["message"]["content"]
 
 
-def llm(prompt: str) -> str:
-    return call_github_models(prompt)
+async def llm(client: httpx.AsyncClient, prompt: str) -> str:
+    return await call_github_models_async(client, prompt)
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def cache_path(prompt: str) -> Path:
+    return CACHE_DIR / (prompt_hash(prompt) + ".txt")
+
+
+def cache_get(prompt: str):
+    p = cache_path(prompt)
+    if p.exists():
+        return p.read_text(encoding="utf-8")
+    return None
+
+
+def cache_put(prompt: str, content: str):
+    CACHE_DIR.mkdir(exist_ok=True)
+    # Write to a temp file first so an interrupted run never leaves a partial entry.
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR, delete=False) as f:
+        f.write(content)
+    os.replace(f.name, cache_path(prompt))
+
+
+async def llm_cached(client: httpx.AsyncClient, prompt: str) -> str:
+    cached = cache_get(prompt)
+    if cached is not None:
+        return cached
+    content = await llm(client, prompt)
+    cache_put(prompt, content)
+    return content
 
 
 def strip_code_fences(s: str) -> str:
     s = s.strip()
     if s.startswith("```"):
-        s = re.sub(r"^```[a-zA-Z]*\n?", "", s)
-        s = re.sub(r"\n?```$", "", s)
+        s = _FENCE_HEAD.sub("", s)
+        s = _FENCE_TAIL.sub("", s)
     return s.strip()
 
 
 def strip_trailing_commas(s: str) -> str:
     # Remove trailing commas before ] or } to tolerate minor JSON issues.
-    return re.sub(r",\s*([\]\}])", r"\1", s)
+    return _TRAIL_COMMA_RE.sub(r"\1", s)
 
 
+def json_loads(s):
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+def compact_json(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def parse_llm_json(raw: str):
+    try:
+        return json_loads(raw)
+    except json.JSONDecodeError:  # orjson.JSONDecodeError subclasses it
+        # Providers that ignore response_format may still wrap or mangle the JSON.
+        return json_loads(strip_trailing_commas(strip_code_fences(raw)))
+
+
+def checkpoint_path(kind: str, number: int) -> Path:
+    if kind == "review":
+        return CHECKPOINT_DIR / f"review_{number}.json"
+    if kind == "final":
+        return CHECKPOINT_DIR / "final_review.json"
+    return CHECKPOINT_DIR / f"unit_{number}_{kind}.json"
+
+
+def load_checkpoint(kind: str, number: int, prompt: str):
+    # A checkpoint only counts for the exact prompt it was generated from, so
+    # edits to subjects.txt regenerate the affected units.
+    p = checkpoint_path(kind, number)
+    if not p.exists():
+        return None
+    try:
+        entry = json_loads(p.read_bytes())
+        if entry.get("prompt_sha256") != prompt_hash(prompt):
+            return None
+        return _VALIDATORS[kind](entry["data"])
+    except (*INVALID_RESPONSE, AttributeError, KeyError):
+        return None
+
+
+def save_checkpoint(kind: str, number: int, prompt: str, data):
+    CHECKPOINT_DIR.mkdir(exist_ok=True)
+    p = checkpoint_path(kind, number)
+    tmp = p.with_suffix(".tmp")
+    tmp.write_text(compact_json({"prompt_sha256": prompt_hash(prompt), "data": data}), encoding="utf-8")
+    os.replace(tmp, p)
+
+
+@functools.lru_cache(maxsize=None)
 def load(path: str) -> str:
+    # Templates are read once per run and shared by every unit.
     return Path(path).read_text(encoding="utf-8")
 
 
@@ -59,10 +214,8 @@ def save(path: str, content: str):
 
 
 def fill(template: str, mapping: dict) -> str:
-    out = template
-    for k, v in mapping.items():
-        out = out.replace("{{" + k + "}}", v)
-    return out
+    # One scan over the template; unknown placeholders are left as-is.
+    return _PLACEHOLDER_RE.sub(lambda m: mapping.get(m.group(1), m.group(0)), template)
 
 
 def html_li(items):
@@ -79,131 +232,218 @@ def html_tr(rows):
 
 # -------------------- Templates --------------------
 
+# Field names match the template placeholders and the prompt schemas.
+
+@dataclass(slots=True)
+class GrammarUnit:
+    level: str
+    unit_number: int
+    unit_title: str
+    heading1: str
+    table1_header_1: str
+    table1_header_2: str
+    table1_rows: list[list[str]]
+    note1: str
+    heading2: str
+    para2: str
+    list2_items: list[str]
+    box1: str
+    heading3: str
+    table2_header_1: str
+    table2_header_2: str
+    table2_rows: list[list[str]]
+    note2: str
+    heading4: str
+    para4: str
+    list4_items: list[str]
+    box2: str
+    taskA_title: str
+    taskA_items: list[str]
+    taskA_mark_note: str
+    taskB_title: str
+    taskB_items: list[str]
+    taskB_mark_note: str
+    taskC_title: str
+    taskC_items: list[str]
+    taskC_mark_note: str
+    taskD_title: str
+    taskD_items: list[str]
+    taskD_mark_note: str
+    taskE_title: str
+    taskE_items: list[str]
+    taskE_mark_note: str
+    taskF_title: str
+    taskF_items: list[str]
+    taskF_mark_note: str
+    total_mark: int
+    max_mark: int
+
+
+@dataclass(slots=True)
+class VocabUnit:
+    level: str
+    unit_number: int
+    unit_title: str
+    topic1_title: str
+    topic2_title: str
+    topic1_rows: list[list[str]]
+    topic2_rows: list[list[str]]
+    verbs_heading: str
+    verbs_rows: list[list[str]]
+    vocab_box: str
+    taskA_title: str
+    taskA_wordbox: str
+    taskA_items: list[str]
+    taskA_mark_note: str
+    taskB_title: str
+    taskB_wordbox: str
+    taskB_items: list[str]
+    taskB_mark_note: str
+    taskC_title: str
+    taskC_items: list[str]
+    taskC_mark_note: str
+    taskD_title: str
+    taskD_items: list[str]
+    taskD_mark_note: str
+    taskE_title: str
+    taskE_items: list[str]
+    taskE_mark_note: str
+    taskF_title: str
+    taskF_items: list[str]
+    taskF_mark_note: str
+    total_mark: int
+    max_mark: int
+
+
+@dataclass(slots=True)
+class MiniReview:
+    review_number: int
+    unit_range: str
+    sectionA_title: str
+    sectionA_items: list[str]
+    sectionB_title: str
+    sectionB_items: list[str]
+    sectionC_title: str
+    sectionC_items: list[str]
+    sectionD_title: str
+    sectionD_items: list[str]
+    sectionE_title: str
+    sectionE_items: list[str]
+    total_mark: int
+
+
+@dataclass(slots=True)
+class BigReview:
+    unit_range: str
+    final_p1_items: list[str]
+    final_p2_items: list[str]
+    final_p3_items: list[str]
+    total_mark: int
+
+
+def template_mapping(obj) -> dict:
+    # Table rows become <tr> markup, other lists <li> items, scalars their text.
+    m = {}
+    for name in obj.__slots__:
+        v = getattr(obj, name)
+        if isinstance(v, list):
+            m[name] = html_tr(v) if v and isinstance(v[0], list) else html_li(v)
+        else:
+            m[name] = str(v)
+    return m
+
+
 def build_grammar_unit(data: dict) -> str:
-    tpl = load("grammar_unit.html")
-    m = {
-        "unit_number": str(data["unit_number"]),
-        "unit_title": data["unit_title"],
-        "level": data["level"],
-        "heading1": data["heading1"],
-        "table1_header_1": data["table1_header_1"],
-        "table1_header_2": data["table1_header_2"],
-        "table1_rows": html_tr(data["table1_rows"]),
-        "note1": data["note1"],
-        "heading2": data["heading2"],
-        "para2": data["para2"],
-        "list2_items": html_li(data["list2_items"]),
-        "box1": data["box1"],
-
-        "heading3": data["heading3"],
-        "table2_header_1": data["table2_header_1"],
-        "table2_header_2": data["table2_header_2"],
-        "table2_rows": html_tr(data["table2_rows"]),
-        "note2": data["note2"],
-        "heading4": data["heading4"],
-        "para4": data["para4"],
-        "list4_items": html_li(data["list4_items"]),
-        "box2": data["box2"],
-
-        "taskA_title": data["taskA_title"],
-        "taskA_items": html_li(data["taskA_items"]),
-        "taskA_mark_note": data["taskA_mark_note"],
-        "taskB_title": data["taskB_title"],
-        "taskB_items": html_li(data["taskB_items"]),
-        "taskB_mark_note": data["taskB_mark_note"],
-        "taskC_title": data["taskC_title"],
-        "taskC_items": html_li(data["taskC_items"]),
-        "taskC_mark_note": data["taskC_mark_note"],
-
-        "taskD_title": data["taskD_title"],
-        "taskD_items": html_li(data["taskD_items"]),
-        "taskD_mark_note": data["taskD_mark_note"],
-        "taskE_title": data["taskE_title"],
-        "taskE_items": html_li(data["taskE_items"]),
-        "taskE_mark_note": data["taskE_mark_note"],
-        "taskF_title": data["taskF_title"],
-        "taskF_items": html_li(data["taskF_items"]),
-        "taskF_mark_note": data["taskF_mark_note"],
-
-        "total_mark": str(data["total_mark"]),
-        "max_mark": str(data["max_mark"]),
-    }
-    return fill(tpl, m)
+    return fill(load("grammar_unit.html"), template_mapping(GrammarUnit(**data)))
 
 
 def build_vocab_unit(data: dict) -> str:
-    tpl = load("vocab_unit.html")
-    m = {
-        "unit_number": str(data["unit_number"]),
-        "unit_title": data["unit_title"],
-        "level": data["level"],
-
-        "topic1_title": data["topic1_title"],
-        "topic1_rows": html_tr(data["topic1_rows"]),
-        "topic2_title": data["topic2_title"],
-        "topic2_rows": html_tr(data["topic2_rows"]),
-        "verbs_heading": data["verbs_heading"],
-        "verbs_rows": html_tr(data["verbs_rows"]),
-        "vocab_box": data["vocab_box"],
-
-        "taskA_title": data["taskA_title"],
-        "taskA_wordbox": data["taskA_wordbox"],
-        "taskA_items": html_li(data["taskA_items"]),
-        "taskA_mark_note": data["taskA_mark_note"],
-        "taskB_title": data["taskB_title"],
-        "taskB_wordbox": data["taskB_wordbox"],
-        "taskB_items": html_li(data["taskB_items"]),
-        "taskB_mark_note": data["taskB_mark_note"],
-        "taskC_title": data["taskC_title"],
-        "taskC_items": html_li(data["taskC_items"]),
-        "taskC_mark_note": data["taskC_mark_note"],
-
-        "taskD_title": data["taskD_title"],
-        "taskD_items": html_li(data["taskD_items"]),
-        "taskD_mark_note": data["taskD_mark_note"],
-        "taskE_title": data["taskE_title"],
-        "taskE_items": html_li(data["taskE_items"]),
-        "taskE_mark_note": data["taskE_mark_note"],
-        "taskF_title": data["taskF_title"],
-        "taskF_items": html_li(data["taskF_items"]),
-        "taskF_mark_note": data["taskF_mark_note"],
-
-        "total_mark": str(data["total_mark"]),
-        "max_mark": str(data["max_mark"]),
-    }
-    return fill(tpl, m)
+    return fill(load("vocab_unit.html"), template_mapping(VocabUnit(**data)))
 
 
 def build_mini_review(data: dict) -> str:
-    tpl = load("review_1page.html")
-    m = {
-        "review_number": str(data["review_number"]),
-        "unit_range": data["unit_range"],
-        "sectionA_title": data["sectionA_title"],
-        "sectionA_items": html_li(data["sectionA_items"]),
-        "sectionB_title": data["sectionB_title"],
-        "sectionB_items": html_li(data["sectionB_items"]),
-        "sectionC_title": data["sectionC_title"],
-        "sectionC_items": html_li(data["sectionC_items"]),
-        "sectionD_title": data["sectionD_title"],
-        "sectionD_items": html_li(data["sectionD_items"]),
-        "sectionE_title": data["sectionE_title"],
-        "sectionE_items": html_li(data["sectionE_items"]),
-        "total_mark": str(data["total_mark"]),
-    }
-    return fill(tpl, m)
+    return fill(load("review_1page.html"), template_mapping(MiniReview(**data)))
 
 
 def build_big_review(data: dict) -> str:
-    tpl = load("final_review_3page.html")
-    m = {
-        "unit_range": data["unit_range"],
-        "final_p1_items": html_li(data["final_p1_items"]),
-        "final_p2_items": html_li(data["final_p2_items"]),
-        "final_p3_items": html_li(data["final_p3_items"]),
-        "total_mark": str(data["total_mark"]),
-    }
-    return fill(tpl, m)
+    return fill(load("final_review_3page.html"), template_mapping(BigReview(**data)))
+
+
+# -------------------- Batch --------------------
+
+def batch_custom_id(kind: str, number: int) -> str:
+    return f"{kind}-{number}"
+
+
+def build_all_prompts(jobs) -> list:
+    return [
+        {
+            "custom_id": batch_custom_id(kind, number),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": chat_payload(prompt),
+        }
+        for kind, number, _, prompt in jobs
+    ]
+
+
+async def run_batch(client: httpx.AsyncClient, jobs) -> list:
+    key = os.getenv("OPENAI_API_KEY")
+    if not key:
+        raise SystemExit("Set OPENAI_API_KEY (required when USE_BATCH=1)")
+    headers = {"Authorization": f"Bearer {key}"}
+
+    lines = "".join(compact_json(e) + "\n" for e in build_all_prompts(jobs))
+    r = await client.post(
+        f"{BATCH_BASE_URL}/files",
+        headers=headers,
+        data={"purpose": "batch"},
+        files={"file": ("book_prompts.jsonl", lines.encode("utf-8"), "application/jsonl")},
+    )
+    r.raise_for_status()
+    r = await client.post(
+        f"{BATCH_BASE_URL}/batches",
+        headers=headers,
+        json={
+            "input_file_id": r.json()["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        },
+    )
+    r.raise_for_status()
+    batch = r.json()
+
+    while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        r = await client.get(f"{BATCH_BASE_URL}/batches/{batch['id']}", headers=headers)
+        r.raise_for_status()
+        batch = r.json()
+
+    # Expired or cancelled batches can still carry partial output worth keeping.
+    error_note = f" (errors: file {batch['error_file_id']})" if batch.get("error_file_id") else ""
+    if not batch.get("output_file_id"):
+        raise SystemExit(f"Batch {batch['id']} ended with status {batch['status']} and no output{error_note}")
+
+    r = await client.get(f"{BATCH_BASE_URL}/files/{batch['output_file_id']}/content", headers=headers)
+    r.raise_for_status()
+    contents = {}
+    for line in r.text.splitlines():
+        if not line.strip():
+            continue
+        item = json_loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            continue
+        contents[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+    if not contents:
+        raise SystemExit(f"Batch {batch['id']} ({batch['status']}) returned no usable output{error_note}")
+    failed = sum(1 for k, n, _, _ in jobs if batch_custom_id(k, n) not in contents)
+    if failed:
+        print(f"Batch {batch['id']} ({batch['status']}): {failed} of {len(jobs)} requests "
+              f"failed or missing{error_note}; retrying them in real time")
+    # None marks a request the caller should send to the real-time endpoint instead.
+    return [contents.get(batch_custom_id(kind, number)) for kind, number, _, _ in jobs]
 
 
 # -------------------- PDF compatibility --------------------
@@ -280,39 +520,9 @@ def level_sentence_rule(level: str) -> str:
     return "Keep sentences concise and level-appropriate."
 
 
-def grammar_prompt(unit, unit_number: int):
-    level = unit["level"]
-    vocab_topics = ", ".join(unit["vocab_topics"])
-    rule = level_sentence_rule(level)
-
-    return f"""
-You are a senior German teacher and book writer (18+ years experience).
-Create content STRICTLY for level {level}.
-{rule}
-Adult-neutral tone. No childish tone.
-No grammar above the level.
-Follow Destination-style logic: clear rules, controlled practice, and a professional workbook style.
-
-UNIT META:
-level: "{level}"
-unit_number: {unit_number}
-unit_title: "{unit['unit_title']}"
-grammar_focus: "{unit['grammar_focus']}"
-vocab_context: "{vocab_topics}"
-
-OUTPUT FORMAT:
-Return ONLY valid JSON. No comments. No markdown.
-
-TASK:
-Generate data for ONE Grammar Unit.
-- Page 1: explanation + short examples.
-- Pages 2-3: 90-120 total exercise items across A-F.
-
-JSON SCHEMA (fill all fields):
-{json.dumps({
-  "level": level,
-  "unit_number": unit_number,
-  "unit_title": unit["unit_title"],
+# Static parts of each JSON skeleton. Per-unit fields (level, numbers,
+# titles) are prepended by schema_with_header() when the prompt is built.
+GRAMMAR_SKELETON = {
   "heading1": "",
   "table1_header_1": "",
   "table1_header_2": "",
@@ -351,7 +561,141 @@ JSON SCHEMA (fill all fields):
   "taskF_mark_note": "1 Punkt pro Satz",
   "total_mark": 90,
   "max_mark": 90
-}, ensure_ascii=False, indent=2)}
+}
+
+VOCAB_SKELETON = {
+  "topic1_rows": [["", "", ""] for _ in range(8)],
+  "topic2_rows": [["", "", ""] for _ in range(8)],
+  "verbs_heading": "Wichtige Verben",
+  "verbs_rows": [["", ""] for _ in range(6)],
+  "vocab_box": "",
+  "taskA_title": "",
+  "taskA_wordbox": "",
+  "taskA_items": ["" for _ in range(15)],
+  "taskA_mark_note": "1 Punkt pro Satz",
+  "taskB_title": "",
+  "taskB_wordbox": "",
+  "taskB_items": ["" for _ in range(15)],
+  "taskB_mark_note": "1 Punkt pro Satz",
+  "taskC_title": "",
+  "taskC_items": ["" for _ in range(15)],
+  "taskC_mark_note": "1 Punkt pro Satz",
+  "taskD_title": "",
+  "taskD_items": ["" for _ in range(15)],
+  "taskD_mark_note": "1 Punkt pro Satz",
+  "taskE_title": "",
+  "taskE_items": ["" for _ in range(15)],
+  "taskE_mark_note": "1 Punkt pro Satz",
+  "taskF_title": "",
+  "taskF_items": ["" for _ in range(15)],
+  "taskF_mark_note": "1 Punkt pro Satz",
+  "total_mark": 90,
+  "max_mark": 90
+}
+
+MINI_REVIEW_SKELETON = {
+  "sectionA_title": "",
+  "sectionA_items": ["" for _ in range(10)],
+  "sectionB_title": "",
+  "sectionB_items": ["" for _ in range(10)],
+  "sectionC_title": "",
+  "sectionC_items": ["" for _ in range(10)],
+  "sectionD_title": "",
+  "sectionD_items": ["" for _ in range(10)],
+  "sectionE_title": "",
+  "sectionE_items": ["" for _ in range(10)],
+  "total_mark": 50
+}
+
+BIG_REVIEW_SKELETON = {
+  "final_p1_items": ["" for _ in range(50)],
+  "final_p2_items": ["" for _ in range(50)],
+  "final_p3_items": ["" for _ in range(50)],
+  "total_mark": 150
+}
+
+
+# Serialised once; the leading "{" is dropped so a header can be spliced in.
+_GRAMMAR_SCHEMA = compact_json(GRAMMAR_SKELETON)[1:]
+_VOCAB_SCHEMA = compact_json(VOCAB_SKELETON)[1:]
+_MINI_REVIEW_SCHEMA = compact_json(MINI_REVIEW_SKELETON)[1:]
+_BIG_REVIEW_SCHEMA = compact_json(BIG_REVIEW_SKELETON)[1:]
+
+
+def schema_with_header(header: dict, body: str) -> str:
+    return compact_json(header)[:-1] + "," + body
+
+
+def skeleton_schema(skeleton) -> dict:
+    # Derive a JSON Schema from an example value: same keys, same value types.
+    if isinstance(skeleton, dict):
+        return {
+            "type": "object",
+            "properties": {k: skeleton_schema(v) for k, v in skeleton.items()},
+            "required": list(skeleton),
+            # Unknown keys would not fit the unit dataclasses; retry instead.
+            "additionalProperties": False,
+        }
+    if isinstance(skeleton, list):
+        return {"type": "array", "items": skeleton_schema(skeleton[0])}
+    if isinstance(skeleton, int):
+        return {"type": "integer"}
+    return {"type": "string"}
+
+
+_VALIDATORS = {
+    "grammar": fastjsonschema.compile(skeleton_schema(
+        {"level": "", "unit_number": 0, "unit_title": "", **GRAMMAR_SKELETON}
+    )),
+    "vocab": fastjsonschema.compile(skeleton_schema(
+        {"level": "", "unit_number": 0, "unit_title": "", "topic1_title": "", "topic2_title": "", **VOCAB_SKELETON}
+    )),
+    "review": fastjsonschema.compile(skeleton_schema(
+        {"review_number": 0, "unit_range": "", **MINI_REVIEW_SKELETON}
+    )),
+    "final": fastjsonschema.compile(skeleton_schema(
+        {"unit_range": "", **BIG_REVIEW_SKELETON}
+    )),
+}
+
+INVALID_RESPONSE = (json.JSONDecodeError, fastjsonschema.JsonSchemaException)
+
+
+def parse_response(kind: str, raw: str):
+    # Fail fast here rather than with a KeyError deep inside build_*().
+    return _VALIDATORS[kind](parse_llm_json(raw))
+
+
+def grammar_prompt(unit, unit_number: int):
+    level = unit["level"]
+    vocab_topics = ", ".join(unit["vocab_topics"])
+    rule = level_sentence_rule(level)
+
+    return f"""
+You are a senior German teacher and book writer (18+ years experience).
+Create content STRICTLY for level {level}.
+{rule}
+Adult-neutral tone. No childish tone.
+No grammar above the level.
+Follow Destination-style logic: clear rules, controlled practice, and a professional workbook style.
+
+UNIT META:
+level: "{level}"
+unit_number: {unit_number}
+unit_title: "{unit['unit_title']}"
+grammar_focus: "{unit['grammar_focus']}"
+vocab_context: "{vocab_topics}"
+
+OUTPUT FORMAT:
+Return ONLY valid JSON. No comments. No markdown.
+
+TASK:
+Generate data for ONE Grammar Unit.
+- Page 1: explanation + short examples.
+- Pages 2-3: 90-120 total exercise items across A-F.
+
+JSON SCHEMA (fill all fields):
+{schema_with_header({"level": level, "unit_number": unit_number, "unit_title": unit["unit_title"]}, _GRAMMAR_SCHEMA)}
 """.strip()
 
 
@@ -385,40 +729,7 @@ Generate data for ONE Vocabulary Unit.
 - Pages 2-3: 90-120 total exercise items across A-F.
 
 JSON SCHEMA (fill all fields):
-{json.dumps({
-  "level": level,
-  "unit_number": unit_number,
-  "unit_title": unit["unit_title"],
-  "topic1_title": topic1,
-  "topic1_rows": [["", "", ""] for _ in range(8)],
-  "topic2_title": topic2,
-  "topic2_rows": [["", "", ""] for _ in range(8)],
-  "verbs_heading": "Wichtige Verben",
-  "verbs_rows": [["", ""] for _ in range(6)],
-  "vocab_box": "",
-  "taskA_title": "",
-  "taskA_wordbox": "",
-  "taskA_items": ["" for _ in range(15)],
-  "taskA_mark_note": "1 Punkt pro Satz",
-  "taskB_title": "",
-  "taskB_wordbox": "",
-  "taskB_items": ["" for _ in range(15)],
-  "taskB_mark_note": "1 Punkt pro Satz",
-  "taskC_title": "",
-  "taskC_items": ["" for _ in range(15)],
-  "taskC_mark_note": "1 Punkt pro Satz",
-  "taskD_title": "",
-  "taskD_items": ["" for _ in range(15)],
-  "taskD_mark_note": "1 Punkt pro Satz",
-  "taskE_title": "",
-  "taskE_items": ["" for _ in range(15)],
-  "taskE_mark_note": "1 Punkt pro Satz",
-  "taskF_title": "",
-  "taskF_items": ["" for _ in range(15)],
-  "taskF_mark_note": "1 Punkt pro Satz",
-  "total_mark": 90,
-  "max_mark": 90
-}, ensure_ascii=False, indent=2)}
+{schema_with_header({"level": level, "unit_number": unit_number, "unit_title": unit["unit_title"], "topic1_title": topic1, "topic2_title": topic2}, _VOCAB_SCHEMA)}
 """.strip()
 
 
@@ -444,29 +755,20 @@ TASK:
 Generate data for ONE mini review page (50 tasks total).
 
 JSON SCHEMA (fill all fields):
-{json.dumps({
-  "review_number": review_number,
-  "unit_range": unit_range,
-  "sectionA_title": "",
-  "sectionA_items": ["" for _ in range(10)],
-  "sectionB_title": "",
-  "sectionB_items": ["" for _ in range(10)],
-  "sectionC_title": "",
-  "sectionC_items": ["" for _ in range(10)],
-  "sectionD_title": "",
-  "sectionD_items": ["" for _ in range(10)],
-  "sectionE_title": "",
-  "sectionE_items": ["" for _ in range(10)],
-  "total_mark": 50
-}, ensure_ascii=False, indent=2)}
+{schema_with_header({"review_number": review_number, "unit_range": unit_range}, _MINI_REVIEW_SCHEMA)}
 """.strip()
 
 
-def big_review_prompt(unit_range: str, units):
+def big_review_prompt(unit_range: str, units, topics=None, grammar=None):
     level = units[-1]["level"]
     rule = level_sentence_rule(level)
-    topics = ", ".join(sorted({t for u in units for t in u["vocab_topics"]}))
-    grammar = ", ".join(sorted({u["grammar_focus"] for u in units}))
+    # plan_jobs() passes the sets it collected while walking the units.
+    if topics is None:
+        topics = sorted({t for u in units for t in u["vocab_topics"]})
+    if grammar is None:
+        grammar = sorted({u["grammar_focus"] for u in units})
+    topics = ", ".join(topics)
+    grammar = ", ".join(grammar)
 
     return f"""
 You are a senior German teacher and book writer (18+ years experience).
@@ -484,24 +786,19 @@ TASK:
 Generate data for ONE final review (3 pages, 150 tasks total).
 
 JSON SCHEMA (fill all fields):
-{json.dumps({
-  "unit_range": unit_range,
-  "final_p1_items": ["" for _ in range(50)],
-  "final_p2_items": ["" for _ in range(50)],
-  "final_p3_items": ["" for _ in range(50)],
-  "total_mark": 150
-}, ensure_ascii=False, indent=2)}
+{schema_with_header({"unit_range": unit_range}, _BIG_REVIEW_SCHEMA)}
 """.strip()
 
 
 # -------------------- HTML assembly --------------------
 
 def extract_pages(html: str):
-    return re.findall(r"<section class=\"page\">.*?</section>", html, re.S)
+    root = lxhtml.document_fromstring(html)
+    sections = root.xpath('//section[contains(concat(" ", normalize-space(@class), " "), " page ")]')
+    return [lxhtml.tostring(sec, encoding="unicode", with_tail=False) for sec in sections]
 
 
-def assemble_book(pages):
-    head = """
+BOOK_HEAD = """
 <!doctype html>
 <html lang="de">
 <head>
@@ -511,25 +808,136 @@ def assemble_book(pages):
 </head>
 <body>
 """.strip()
-    tail = "\n</body>\n</html>\n"
-    body = "\n".join(pages)
-    return head + "\n" + body + tail
+BOOK_TAIL = "\n</body>\n</html>\n"
+
+
+def assemble_book(pages, first_page: int = 1):
+    # Write straight into one buffer instead of concatenating multi-MB strings.
+    buf = io.StringIO()
+    if first_page == 1:
+        buf.write(BOOK_HEAD)
+    else:
+        # Chunks rendered separately continue the book's page numbering.
+        buf.write(BOOK_HEAD.replace(
+            "</head>", f"  <style>@page :first {{ counter-reset: page {first_page} }}</style>\n</head>"
+        ))
+    for page in pages:
+        buf.write("\n")
+        buf.write(page)
+    buf.write(BOOK_TAIL)
+    return buf.getvalue()
+
+
+# -------------------- PDF rendering --------------------
+
+# Fonts are already subset without hinting by default; only images need opting in.
+PDF_OPTIONS = {
+    "optimize_images": True,
+    "jpeg_quality": 85,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def shared_font_config() -> FontConfiguration:
+    # One per worker process, reused for every chunk it renders.
+    return FontConfiguration()
+
+
+def render_chunk(html: str, base_url: str) -> bytes:
+    ensure_pydyf_transform()
+    ensure_pydyf_text_matrix()
+    return HTML(string=html, base_url=base_url).write_pdf(font_config=shared_font_config(), **PDF_OPTIONS)
+
+
+def render_pdf(chunks, output_pdf: str):
+    # Each chunk (one unit or review) is rendered in its own process, then merged.
+    chunks = [c for c in chunks if c]
+    base_url = str(Path.cwd())
+    # Every <section class="page"> forces a page break, so expect one page each.
+    starts = list(accumulate([1] + [len(c) for c in chunks[:-1]]))
+
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS) as ex:
+        htmls = [assemble_book(c, s) for c, s in zip(chunks, starts)]
+        pdfs = list(ex.map(render_chunk, htmls, repeat(base_url)))
+
+        # A section that overflows shifts the numbering of every later chunk.
+        counts = [len(PdfReader(io.BytesIO(b)).pages) for b in pdfs]
+        actual = list(accumulate([1] + counts[:-1]))
+        redo = [i for i in range(len(chunks)) if actual[i] != starts[i]]
+        if redo:
+            htmls = [assemble_book(chunks[i], actual[i]) for i in redo]
+            for i, b in zip(redo, ex.map(render_chunk, htmls, repeat(base_url))):
+                pdfs[i] = b
+
+    writer = PdfWriter()
+    for b in pdfs:
+        writer.append(io.BytesIO(b))
+    # append() drops document info; keep the /Title etc. WeasyPrint wrote.
+    metadata = PdfReader(io.BytesIO(pdfs[0])).metadata
+    if metadata:
+        writer.add_metadata(metadata)
+    writer.write(output_pdf)
 
 
 # -------------------- Main --------------------
 
-def main():
-    subjects = parse_subjects(SUBJECTS_FILE)
+BUILDERS = {
+    "vocab": build_vocab_unit,
+    "grammar": build_grammar_unit,
+    "review": build_mini_review,
+    "final": build_big_review,
+}
+
+
+def plan_jobs(subjects):
+    # One (kind, number, label, prompt) per LLM call, in book order.
+    jobs = []
+    review_number = 1
+    all_topics, all_grammar = set(), set()
+    for idx, unit in enumerate(subjects, 1):
+        all_topics.update(unit["vocab_topics"])
+        all_grammar.add(unit["grammar_focus"])
+        jobs.append(("vocab", idx, f"Vocabulary Unit {idx}", vocab_prompt(unit, idx)))
+        jobs.append(("grammar", idx, f"Grammar Unit {idx}", grammar_prompt(unit, idx)))
+
+        # Mini review after every 2 units (Variant A)
+        if idx % 2 == 0:
+            unit_range = f"Units {idx-1}–{idx}"
+            jobs.append((
+                "review", review_number, f"Mini Review {review_number} ({unit_range})",
+                mini_review_prompt(review_number, unit_range, subjects[idx-2:idx]),
+            ))
+            review_number += 1
 
-    default_name = BOOK_PDF
-    user_name = input(f"Output PDF name [{default_name}]: ").strip()
-    output_pdf = user_name if user_name else default_name
+    # Big review for the whole book, reusing the sets collected above
+    unit_range = f"Units 1–{len(subjects)}"
+    jobs.append((
+        "final", 1, f"Final Review ({unit_range})",
+        big_review_prompt(unit_range, subjects, topics=sorted(all_topics), grammar=sorted(all_grammar)),
+    ))
+    return jobs
+
+
+def resolve_output_pdf(arg) -> str:
+    # -o/--output, then $BOOK_PDF; only ask interactively when a terminal is attached.
+    output_pdf = arg or os.getenv("BOOK_PDF")
+    if not output_pdf:
+        output_pdf = BOOK_PDF
+        if sys.stdin.isatty():
+            output_pdf = input(f"Output PDF name [{BOOK_PDF}]: ").strip() or BOOK_PDF
     if not output_pdf.lower().endswith(".pdf"):
         output_pdf += ".pdf"
+    return output_pdf
+
+
+async def main_async():
+    subjects = parse_subjects(SUBJECTS_FILE)
+    if CLEAR_CACHE:
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
 
-    total_units = len(subjects)
-    total_mini_reviews = total_units // 2
-    total_steps = total_units * 2 + total_mini_reviews + 1  # +1 for big review
+    jobs = plan_jobs(subjects)
+    total_steps = len(jobs)
     completed = 0
 
     def step(msg: str):
@@ -538,57 +946,76 @@ def main():
         pct = int((completed / total_steps) * 100)
         print(f"[{pct:3d}%] {msg}")
 
-    pages = []
-    unit_number = 1
-    review_number = 1
-
-    for idx, unit in enumerate(subjects, 1):
-        # 1) Vocabulary unit
-        step(f"Vocabulary Unit {unit_number}: generating...")
-        v_prompt = vocab_prompt(unit, unit_number)
-        v_raw = strip_code_fences(llm(v_prompt))
-        v_data = json.loads(strip_trailing_commas(v_raw))
-        v_html = build_vocab_unit(v_data)
-        pages.extend(extract_pages(v_html))
-
-        # 2) Grammar unit
-        step(f"Grammar Unit {unit_number}: generating...")
-        g_prompt = grammar_prompt(unit, unit_number)
-        g_raw = strip_code_fences(llm(g_prompt))
-        g_data = json.loads(strip_trailing_commas(g_raw))
-        g_html = build_grammar_unit(g_data)
-        pages.extend(extract_pages(g_html))
+    results = [None] * len(jobs)
+    pending = []
+    for i, (kind, number, label, prompt) in enumerate(jobs):
+        data = load_checkpoint(kind, number, prompt)
+        if data is None:
+            pending.append(i)
+        else:
+            results[i] = data
+            step(f"{label}: loaded from checkpoint")
+
+    def finish(i: int, data):
+        kind, number, label, prompt = jobs[i]
+        save_checkpoint(kind, number, prompt, data)
+        results[i] = data
+        step(f"{label}: generated")
+
+    sem = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    async def generate(client, i, raw=None):
+        kind, _, label, prompt = jobs[i]
+        for attempt in range(1, LLM_ATTEMPTS + 1):
+            if raw is None:
+                async with sem:
+                    raw = await llm_cached(client, prompt)
+            try:
+                return finish(i, parse_response(kind, raw))
+            except INVALID_RESPONSE as e:
+                # Drop the bad response so the next attempt asks the model again.
+                cache_path(prompt).unlink(missing_ok=True)
+                if attempt == LLM_ATTEMPTS:
+                    raise SystemExit(f"{label}: invalid response after {attempt} attempts: {e}")
+                print(f"{label}: invalid response ({e}), retrying...")
+                raw = None
+
+    async with new_client() as client:
+        raws = {}
+        if USE_BATCH:
+            raws = {i: cache_get(jobs[i][3]) for i in pending}
+            todo = [i for i in pending if raws[i] is None]
+            if todo:
+                print(f"Submitting batch of {len(todo)} prompts...")
+                for i, raw in zip(todo, await run_batch(client, [jobs[i] for i in todo])):
+                    if raw is not None:
+                        cache_put(jobs[i][3], raw)
+                    raws[i] = raw
+        # In batch mode only invalid responses reach the real-time endpoint.
+        await asyncio.gather(
+            *[generate(client, i, raws.get(i)) for i in pending],
+            return_exceptions=False,
+        )
 
-        # Mini review after every 2 units (Variant A)
-        if idx % 2 == 0:
-            unit_range = f"Units {idx-1}–{idx}"
-            step(f"Mini Review {review_number} ({unit_range}): generating...")
-            m_prompt = mini_review_prompt(review_number, unit_range, subjects[idx-2:idx])
-            m_raw = strip_code_fences(llm(m_prompt))
-            m_data = json.loads(strip_trailing_commas(m_raw))
-            m_html = build_mini_review(m_data)
-            pages.extend(extract_pages(m_html))
-            review_number += 1
+    chunks = [extract_pages(BUILDERS[kind](data)) for (kind, _, _, _), data in zip(jobs, results)]
 
-        unit_number += 1
+    if DEBUG_HTML:
+        save(BOOK_HTML, assemble_book(chain.from_iterable(chunks)))
 
-    # Big review for the whole book
-    unit_range = f"Units 1–{len(subjects)}"
-    step(f"Final Review ({unit_range}): generating...")
-    b_prompt = big_review_prompt(unit_range, subjects)
-    b_raw = strip_code_fences(llm(b_prompt))
-    b_data = json.loads(strip_trailing_commas(b_raw))
-    b_html = build_big_review(b_data)
-    pages.extend(extract_pages(b_html))
+    return chunks
 
-    # Assemble and render
-    book_html = assemble_book(pages)
-    save(BOOK_HTML, book_html)
 
-    ensure_pydyf_transform()
-    ensure_pydyf_text_matrix()
-    print("[99%] Rendering PDF...")
-    HTML(filename=BOOK_HTML).write_pdf(output_pdf)
+def main():
+    ap = argparse.ArgumentParser(description="Generate the German workbook PDF from subjects.txt.")
+    ap.add_argument("-o", "--output", help=f"output PDF name (default: $BOOK_PDF or {BOOK_PDF!r})")
+    args = ap.parse_args()
+    output_pdf = resolve_output_pdf(args.output)
+    chunks = asyncio.run(main_async())
+
+    # Render only after the event loop (and its resolver threads) has shut
+    # down, so the process pool never forks a multi-threaded parent.
+    print(f"[99%] Rendering PDF ({len(chunks)} parts)...")
+    render_pdf(chunks, output_pdf)
     print(f"[100%] Done: {output_pdf}")
 
 